@@ -1,15 +1,48 @@
+import atexit
 import json
 import base64
+import logging
+import mmap
+import operator
+import os
+import queue
+import re
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
 from pathlib import Path
 import sys
 
 try:
     import UnityPy
     from UnityPy.enums import ClassIDType
+    from PIL import Image
 except ImportError:
     print("[ERROR] UnityPy not installed. Run: pip install UnityPy")
     sys.exit(1)
 
+# Optional: orjson serializes the preset much faster, fall back to json
+try:
+    import orjson
+    
+    def _dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj, indent=2).encode('utf-8')
+
+# Optional: pyspng (libspng) encodes PNGs faster than Pillow. Only the
+# pyspng-seunglab build can encode; the PyPI "pyspng" package is decode-only
+# but installs the same module name.
+try:
+    import numpy as np
+    import pyspng
+    if not hasattr(pyspng, "encode"):
+        pyspng = None
+except ImportError:
+    pyspng = None
+
 # ------------------ CONFIG ------------------
 
 INPUT_DIR = Path("input")
@@ -18,6 +51,38 @@ OUTPUT_GEO = OUTPUT_DIR / "CustomGeometry"
 OUTPUT_TEX = OUTPUT_DIR / "CustomTextures"
 OUTPUT_PRESETS = OUTPUT_DIR / "Presets"
 
+# Embed every asset as base64 in the preset's BinaryAssets. The preset already
+# references the files in CustomGeometry/ and CustomTextures/, so this is off
+# by default and only needed for a self-contained preset.
+EMBED_BINARY = False
+# With EMBED_BINARY, write each asset's base64 to a sidecar .b64 file under
+# Presets/<saber>_assets/ and reference it as "DataFile" instead of inlining
+# "Data". Requires a loader that understands DataFile.
+SIDECAR_ASSETS = False
+
+# Placeholders for Modules/BinaryAssets while the rest of the preset is serialized
+MODULES_MARKER = "__MODULES__"
+BINARY_ASSETS_MARKER = "__BINARY_ASSETS__"
+# Bytes read per base64 chunk when embedding (multiple of 3)
+BASE64_CHUNK_SIZE = 57 * 1024
+
+# zlib level for PNG output; 1 is much faster than Pillow's default of 6
+PNG_COMPRESS_LEVEL = 1
+# Image modes pyspng can encode directly, anything else goes through Pillow
+PYSPNG_MODES = {"L", "LA", "RGB", "RGBA"}
+# Set OPTIMIZE_PNG=1 to recompress extracted PNGs with oxipng in the background
+OPTIMIZE_PNG = bool(os.environ.get("OPTIMIZE_PNG"))
+
+# Set QUANTIZE=1 to reduce RGB/RGBA textures to a 256-color palette (lossy,
+# but typically a several times smaller PNG)
+QUANTIZE = bool(os.environ.get("QUANTIZE"))
+
+# Characters not allowed in extracted filenames
+_SAN_RE = re.compile(r'[^\w\- ]')
+
+# Pass -v / --verbose to log every extracted asset and generated module
+VERBOSE = "-v" in sys.argv[1:] or "--verbose" in sys.argv[1:]
+
 # ------------------ SETUP ------------------
 
 for folder in [OUTPUT_DIR, OUTPUT_GEO, OUTPUT_TEX, OUTPUT_PRESETS]:
@@ -25,16 +90,42 @@ for folder in [OUTPUT_DIR, OUTPUT_GEO, OUTPUT_TEX, OUTPUT_PRESETS]:
 
 # ------------------ DEBUG HELPERS ------------------
 
-def log(msg):
-    print(f"[INFO] {msg}")
-
-def warn(msg):
-    print(f"[WARN] {msg}")
+# Per-asset messages are logged at DEBUG and only shown with -v; all messages
+# use lazy %-formatting so filtered ones are never formatted.
+# Log records are buffered in memory and written to stdout in batches via
+# flush_log(), instead of one write + flush per line
+class _LogFormatter(logging.Formatter):
+    """Format records as "[LEVEL] message", printing WARNING as WARN"""
+    def format(self, record):
+        level = "WARN" if record.levelno == logging.WARNING else record.levelname
+        return f"[{level}] {record.getMessage()}"
+
+_log_buffer = StringIO()
+log_handler = logging.StreamHandler(_log_buffer)
+log_handler.setFormatter(_LogFormatter())
+logger = logging.getLogger("convert")
+logger.setLevel(logging.DEBUG if VERBOSE else logging.INFO)
+logger.addHandler(log_handler)
+logger.propagate = False
+
+def flush_log():
+    log_handler.flush()
+    sys.stdout.write(_log_buffer.getvalue())
+    sys.stdout.flush()
+    _log_buffer.seek(0)
+    _log_buffer.truncate()
+
+# Don't lose buffered lines if the script dies or is interrupted mid-run
+atexit.register(flush_log)
 
 def error(msg):
-    print(f"[ERROR] {msg}")
+    logger.error(msg)
+    flush_log()
     sys.exit(1)
 
+def _sanitize(name):
+    return _SAN_RE.sub('', name).strip()
+
 # ------------------ FIND SABER FILE ------------------
 
 saber_files = list(INPUT_DIR.glob("*.saber"))
@@ -43,197 +134,273 @@ if not saber_files:
 
 saber_file = saber_files[0]
 saber_name = saber_file.stem
-log(f"Found .saber file: {saber_file.name}")
+logger.info("Found .saber file: %s", saber_file.name)
 
 # ------------------ LOAD ASSETBUNDLE ------------------
 
-log("Loading AssetBundle...")
+logger.info("Loading AssetBundle...")
+flush_log()
+# Memory-map the bundle so pages are read on demand instead of copied into
+# memory up front. UnityPy keeps views into the map, so it stays open for the
+# rest of the run (the file handle itself can be closed right away).
+# The name must be passed explicitly: without it UnityPy hashes the whole
+# buffer to name the file, which reads every page.
 try:
-    env = UnityPy.load(str(saber_file))
+    with open(saber_file, 'rb') as saber_fh:
+        saber_map = mmap.mmap(saber_fh.fileno(), 0, access=mmap.ACCESS_READ)
+    env = UnityPy.Environment(path=str(saber_file.parent))
+    env.load_file(memoryview(saber_map), name=str(saber_file))
 except Exception as e:
     error(f"Failed to load .saber file: {e}")
 
-# ------------------ EXTRACT MESHES ------------------
+# ------------------ EXTRACTION HANDLERS ------------------
 
-log("Extracting meshes...")
 mesh_data = []
+texture_data = []
+sprite_data = []
 
-for obj in env.objects:
-    if obj.type.name == "Mesh":
-        try:
-            data = obj.read()
-            mesh_name = data.name if hasattr(data, 'name') and data.name else f"mesh_{obj.path_id}"
-            
-            # Sanitize filename but keep it simple
-            mesh_name_clean = "".join(c for c in mesh_name if c.isalnum() or c in (' ', '-', '_')).strip()
-            if not mesh_name_clean:
-                mesh_name_clean = f"mesh_{obj.path_id}"
-            
-            # Export mesh as OBJ
-            try:
-                obj_data = data.export()
-                if obj_data and len(obj_data) > 0:
-                    # Convert string to bytes if needed
-                    if isinstance(obj_data, str):
-                        obj_bytes = obj_data.encode('utf-8')
-                    else:
-                        obj_bytes = obj_data
-                    
-                    # Save OBJ file to disk
-                    obj_file = OUTPUT_GEO / f"{mesh_name_clean}.obj"
-                    with open(obj_file, 'wb') as f:
-                        f.write(obj_bytes)
-                    
-                    # Also store base64 for JSON (even though we might not use it)
-                    obj_base64 = base64.b64encode(obj_bytes).decode('utf-8')
-                    mesh_data.append({
-                        "name": mesh_name_clean,
-                        "filename": f"{mesh_name_clean}.obj",
-                        "data": obj_base64,
-                        "original_name": mesh_name
-                    })
-                    log(f"Extracted mesh: {mesh_name_clean}.obj ({len(obj_bytes)} bytes)")
-                else:
-                    warn(f"Empty mesh export for: {mesh_name_clean}")
-            except Exception as export_err:
-                warn(f"Failed to export mesh '{mesh_name_clean}': {export_err}")
-        except Exception as e:
-            warn(f"Failed to process mesh object: {e}")
-
-# ------------------ EXTRACT TEXTURES ------------------
+# UnityPy objects share one underlying reader, so reading/exporting/decoding
+# is serialized; PNG encoding and disk writes run in parallel
+unity_lock = threading.Lock()
 
-log("Extracting textures...")
-texture_data = []
+# Files are written by a background thread so extraction never waits on disk
+write_queue = queue.Queue()
+# Paths the writer failed to write; their assets are dropped after extraction
+failed_writes = set()
 
-for obj in env.objects:
-    if obj.type.name == "Texture2D":
+def _writer_loop():
+    while True:
+        item = write_queue.get()
         try:
-            data = obj.read()
-            tex_name = data.name if hasattr(data, 'name') and data.name else f"texture_{obj.path_id}"
-            
-            # Sanitize filename but keep original for reference
-            tex_name_clean = "".join(c for c in tex_name if c.isalnum() or c in (' ', '-', '_')).strip()
-            if not tex_name_clean:
-                tex_name_clean = f"texture_{obj.path_id}"
-            
-            # Export texture
+            if item is None:
+                return
+            path, data = item
             try:
-                img = data.image
-                from io import BytesIO
-                
-                # Save PNG file to disk
-                tex_file = OUTPUT_TEX / f"{tex_name_clean}.png"
-                img.save(tex_file)
+                path.write_bytes(data)
+            except Exception as e:
+                failed_writes.add(path)
+                logger.warning("Failed to write '%s': %s", path, e)
+        finally:
+            write_queue.task_done()
+
+writer_thread = threading.Thread(target=_writer_loop, daemon=True)
+writer_thread.start()
+
+# One reusable PNG buffer per worker thread, instead of a new BytesIO per image
+_png_local = threading.local()
+
+def encode_png(img):
+    if QUANTIZE and img.mode in ("RGB", "RGBA"):
+        img = img.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+    
+    if pyspng is not None and img.mode in PYSPNG_MODES:
+        return pyspng.encode(np.asarray(img), compress_level=PNG_COMPRESS_LEVEL)
+    
+    buffer = getattr(_png_local, "buffer", None)
+    if buffer is None:
+        buffer = _png_local.buffer = BytesIO()
+    buffer.seek(0)
+    buffer.truncate()
+    img.save(buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL, optimize=False)
+    return buffer.getvalue()
+
+def _handle_mesh(obj):
+    try:
+        with unity_lock:
+            data = obj.read()
+        mesh_name = data.name if hasattr(data, 'name') and data.name else f"mesh_{obj.path_id}"
+        
+        # Sanitize filename but keep it simple
+        mesh_name_clean = _sanitize(mesh_name)
+        if not mesh_name_clean:
+            mesh_name_clean = f"mesh_{obj.path_id}"
+        
+        # Export mesh as OBJ
+        try:
+            with unity_lock:
+                obj_data = data.export()
+            if obj_data and len(obj_data) > 0:
+                # Convert string to bytes if needed
+                if isinstance(obj_data, str):
+                    obj_bytes = obj_data.encode('utf-8')
+                else:
+                    obj_bytes = obj_data
                 
-                # Also create base64 for JSON
-                buffer = BytesIO()
-                img.save(buffer, format='PNG')
-                png_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+                # OBJ file to save, queued by the caller
+                obj_file = OUTPUT_GEO / f"{mesh_name_clean}.obj"
                 
-                texture_data.append({
-                    "name": tex_name_clean,
-                    "filename": f"{tex_name_clean}.png",
-                    "data": png_base64,
-                    "original_name": tex_name
-                })
-                log(f"Extracted texture: {tex_name_clean}.png ({buffer.tell()} bytes)")
-            except Exception as export_err:
-                warn(f"Failed to export texture '{tex_name_clean}': {export_err}")
-        except Exception as e:
-            warn(f"Failed to process texture object: {e}")
-
-# ------------------ EXTRACT SPRITES ------------------
-
-log("Extracting sprites (if any)...")
-
-for obj in env.objects:
-    if obj.type.name == "Sprite":
-        try:
+                logger.debug("Extracted mesh: %s.obj (%d bytes)", mesh_name_clean, len(obj_bytes))
+                return {
+                    "name": mesh_name_clean,
+                    "filename": f"{mesh_name_clean}.obj"
+                }, obj_file, obj_bytes
+            else:
+                logger.warning("Empty mesh export for: %s", mesh_name_clean)
+        except Exception as export_err:
+            logger.warning("Failed to export mesh '%s': %s", mesh_name_clean, export_err)
+    except Exception as e:
+        logger.warning("Failed to process mesh object: %s", e)
+
+def _handle_texture(obj):
+    try:
+        with unity_lock:
             data = obj.read()
-            sprite_name = data.name if hasattr(data, 'name') and data.name else f"sprite_{obj.path_id}"
+        tex_name = data.name if hasattr(data, 'name') and data.name else f"texture_{obj.path_id}"
+        
+        # Sanitize filename but keep original for reference
+        tex_name_clean = _sanitize(tex_name)
+        if not tex_name_clean:
+            tex_name_clean = f"texture_{obj.path_id}"
+        
+        # Export texture
+        try:
+            with unity_lock:
+                img = data.image
             
-            # Sanitize filename
-            sprite_name_clean = "".join(c for c in sprite_name if c.isalnum() or c in (' ', '-', '_')).strip()
-            if not sprite_name_clean:
-                sprite_name_clean = f"sprite_{obj.path_id}"
+            # Encode PNG once
+            png_bytes = encode_png(img)
             
-            # Export sprite
-            try:
+            # PNG file to save, queued by the caller
+            tex_file = OUTPUT_TEX / f"{tex_name_clean}.png"
+            
+            logger.debug("Extracted texture: %s.png (%d bytes)", tex_name_clean, len(png_bytes))
+            return {
+                "name": tex_name_clean,
+                "filename": f"{tex_name_clean}.png"
+            }, tex_file, png_bytes
+        except Exception as export_err:
+            logger.warning("Failed to export texture '%s': %s", tex_name_clean, export_err)
+    except Exception as e:
+        logger.warning("Failed to process texture object: %s", e)
+
+def _handle_sprite(obj):
+    try:
+        with unity_lock:
+            data = obj.read()
+        sprite_name = data.name if hasattr(data, 'name') and data.name else f"sprite_{obj.path_id}"
+        
+        # Sanitize filename
+        sprite_name_clean = _sanitize(sprite_name)
+        if not sprite_name_clean:
+            sprite_name_clean = f"sprite_{obj.path_id}"
+        
+        # Export sprite
+        try:
+            with unity_lock:
                 img = data.image
-                from io import BytesIO
-                
-                # Save PNG file to disk
-                tex_file = OUTPUT_TEX / f"{sprite_name_clean}.png"
-                img.save(tex_file)
-                
-                # Also create base64 for JSON
-                buffer = BytesIO()
-                img.save(buffer, format='PNG')
-                png_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                
-                texture_data.append({
-                    "name": sprite_name_clean,
-                    "filename": f"{sprite_name_clean}.png",
-                    "data": png_base64,
-                    "original_name": sprite_name
-                })
-                log(f"Extracted sprite: {sprite_name_clean}.png ({buffer.tell()} bytes)")
-            except Exception as export_err:
-                warn(f"Failed to export sprite '{sprite_name_clean}': {export_err}")
-        except Exception as e:
-            warn(f"Failed to process sprite object: {e}")
+            
+            # Encode PNG once
+            png_bytes = encode_png(img)
+            
+            # PNG file to save, queued by the caller
+            tex_file = OUTPUT_TEX / f"{sprite_name_clean}.png"
+            
+            logger.debug("Extracted sprite: %s.png (%d bytes)", sprite_name_clean, len(png_bytes))
+            return {
+                "name": sprite_name_clean,
+                "filename": f"{sprite_name_clean}.png"
+            }, tex_file, png_bytes
+        except Exception as export_err:
+            logger.warning("Failed to export sprite '%s': %s", sprite_name_clean, export_err)
+    except Exception as e:
+        logger.warning("Failed to process sprite object: %s", e)
 
-# ------------------ SUMMARY ------------------
+# ------------------ EXTRACT ASSETS ------------------
 
-log(f"\nExtraction complete:")
-log(f"  Meshes: {len(mesh_data)}")
-log(f"  Textures: {len(texture_data)}")
+logger.info("Extracting meshes, textures and sprites...")
 
-if not mesh_data:
-    warn("Warning: No meshes extracted. Preset will be empty.")
+# Single pass over the object table, collecting the objects to extract
+EXTRACT_TYPES = {"Mesh", "Texture2D", "Sprite"}
 
-# ------------------ CATEGORIZE MESHES ------------------
+get_type = operator.attrgetter('type.name')
+items = []
+for obj in env.objects:
+    type_name = get_type(obj)
+    if type_name in EXTRACT_TYPES:
+        items.append((obj, type_name))
+
+def _process(item):
+    obj, type_name = item
+    if type_name == "Mesh":
+        return _handle_mesh(obj)
+    elif type_name == "Texture2D":
+        return _handle_texture(obj)
+    else:
+        return _handle_sprite(obj)
+
+# Results are consumed in object-table order and files are queued from here,
+# not from the workers, so when two assets clean to the same filename the
+# later one in the table deterministically wins
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+    for (obj, type_name), result in zip(items, ex.map(_process, items)):
+        if result is None:
+            continue
+        entry, path, file_bytes = result
+        write_queue.put((path, file_bytes))
+        if type_name == "Mesh":
+            mesh_data.append(entry)
+        elif type_name == "Texture2D":
+            texture_data.append(entry)
+        else:
+            sprite_data.append(entry)
+
+# Wait for all queued files to hit disk, then stop the writer
+write_queue.put(None)
+write_queue.join()
+
+# Drop assets whose file never made it to disk
+if failed_writes:
+    mesh_data = [m for m in mesh_data if OUTPUT_GEO / m["filename"] not in failed_writes]
+    texture_data = [t for t in texture_data if OUTPUT_TEX / t["filename"] not in failed_writes]
+    sprite_data = [s for s in sprite_data if OUTPUT_TEX / s["filename"] not in failed_writes]
+
+# Keep textures ahead of sprites so the trail still picks a real texture first
+texture_data.extend(sprite_data)
+
+# BinaryAssets entries as (AssetName, file on disk); only the file references
+# are kept, the base64 data is streamed from disk when the preset is saved
+binary_assets = {"Textures": [], "Geometry": []}
+if EMBED_BINARY:
+    binary_assets["Textures"] = [(t["filename"], OUTPUT_TEX / t["filename"]) for t in texture_data]
+    binary_assets["Geometry"] = [(m["filename"], OUTPUT_GEO / m["filename"]) for m in mesh_data]
+
+# Optionally recompress the PNGs with oxipng while the preset is generated
+png_optimizer = None
+if OPTIMIZE_PNG and texture_data:
+    png_paths = [str(OUTPUT_TEX / t["filename"]) for t in texture_data]
+    try:
+        png_optimizer = subprocess.Popen(
+            ["oxipng", "-o", "2", "--threads", str(os.cpu_count()), *png_paths],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        logger.info("Optimizing %d PNG(s) with oxipng in the background...", len(png_paths))
+    except FileNotFoundError:
+        logger.warning("OPTIMIZE_PNG is set but oxipng was not found on PATH, skipping")
+
+def wait_png_optimizer():
+    """Wait for the background oxipng run, if any, to finish rewriting files"""
+    if png_optimizer is not None and png_optimizer.wait() != 0:
+        logger.warning("oxipng exited with code %s", png_optimizer.returncode)
 
-def categorize_mesh(name):
-    """Determine if mesh is hilt or blade based on name"""
-    name_lower = name.lower()
-    
-    # Hilt keywords
-    if any(k in name_lower for k in ["hilt", "handle", "grip", "guard", "pommel", "emitter"]):
-        return "hilt"
-    
-    # Blade keywords
-    if any(k in name_lower for k in ["blade", "beam", "glow", "laser"]):
-        return "blade"
-    
-    # Default to hilt for unknown
-    return "hilt"
+# ------------------ SUMMARY ------------------
 
-# ------------------ GENERATE PRESET ------------------
+logger.info("\nExtraction complete:")
+logger.info("  Meshes: %d", len(mesh_data))
+logger.info("  Textures: %d", len(texture_data))
 
-# Pick first texture for trail if available
-trail_texture = texture_data[0]["filename"] if texture_data else ""
+if not mesh_data:
+    logger.warning("Warning: No meshes extracted. Preset will be empty.")
 
-preset = {
-    "ModVersion": "0.3.17",
-    "Version": 1,
-    "RootSettings": {
-        "Type": 0
-    },
-    "LocalTransform": {
-        "Position": {"x": 0.0, "y": 0.0, "z": 0.0},
-        "Rotation": {"x": 0.0, "y": 0.0, "z": 0.0},
-        "Scale": {"x": 1.0, "y": 1.0, "z": 1.0}
-    },
-    "Modules": [],
-    "BinaryAssets": {
-        "Textures": [],
-        "Geometry": []
-    }
-}
+flush_log()
 
-# Add trail module first (like in the example)
-preset["Modules"].append({
+# ------------------ MODULE TEMPLATES ------------------
+
+# Leaf values filled in per preset/mesh; everything else is constant
+TRAIL_TEXTURE_MARKER = "__TRAIL_TEXTURE__"
+MODEL_ID_MARKER = "__MODEL_ID__"
+
+_TRAIL_MODULE_TEMPLATE = {
     "ModuleId": "reezonate.simple-trail",
     "Version": 1,
     "Config": {
@@ -250,8 +417,8 @@ preset["Modules"].append({
             "width": 0.03,
             "distortionMultiplier": 1.0,
             "generalSettings": {
-                "customTextureId": trail_texture,
-                "opacityTextureId": trail_texture,
+                "customTextureId": TRAIL_TEXTURE_MARKER,
+                "opacityTextureId": TRAIL_TEXTURE_MARKER,
                 "animationLayout": {
                     "totalFrames": 1,
                     "framesPerRow": 1,
@@ -354,139 +521,207 @@ preset["Modules"].append({
         }
     },
     "Children": []
-})
+}
 
-# Add each mesh as a custom-model module (directly in Modules, not in containers)
-for mesh in mesh_data:
-    module = {
-        "ModuleId": "reezonate.custom-model",
-        "Version": 1,
-        "Config": {
-            "MeshSettings": {
-                "modelId": mesh["filename"],
-                "scale": 1.0,
-                "flipNormals": False,
-                "mirrorX": False,
-                "mirrorY": False,
-                "mirrorZ": False
-            },
-            "MaterialSettings": {
-                "color": {"r": 1.0, "g": 1.0, "b": 1.0, "a": 1.0},
-                "reflectionColor": {"r": 1.0, "g": 1.0, "b": 1.0, "a": 1.0},
-                "envLightColor": {"r": 1.0, "g": 1.0, "b": 1.0, "a": 1.0},
-                "opacity": 1.0,
-                "fresnelPower": 5.0,
-                "metallic": 0.0,
-                "roughness": 0.0,
-                "envLightIntensity": 1.0,
-                "reflectionIntensity": 1.0,
-                "normalMapIntensity": 1.0,
-                "sceneReflections": False,
-                "sceneLights": False,
-                "renderQueue": 2990,
-                "cullMode": 0,
-                "depthWrite": True,
-                "maskSettings": {
-                    "driversMaskResolution": 32,
-                    "driversSampleMode": 0,
-                    "viewingAngleMappings": {
-                        "colorOverValue": {
-                            "interpolationType": 0,
-                            "controlPoints": [{"time": 0.0, "value": {"r": 1.0, "g": 1.0, "b": 1.0, "a": 1.0}}]
-                        },
-                        "alphaOverValue": {
-                            "interpolationType": 0,
-                            "controlPoints": [{"time": 0.0, "value": 1.0}]
-                        },
-                        "scaleOverValue": {
-                            "interpolationType": 0,
-                            "controlPoints": [{"time": 0.0, "value": 1.0}]
-                        },
-                        "valueFrom": 0.0,
-                        "valueTo": 1.0
+_CUSTOM_MODEL_TEMPLATE = {
+    "ModuleId": "reezonate.custom-model",
+    "Version": 1,
+    "Config": {
+        "MeshSettings": {
+            "modelId": MODEL_ID_MARKER,
+            "scale": 1.0,
+            "flipNormals": False,
+            "mirrorX": False,
+            "mirrorY": False,
+            "mirrorZ": False
+        },
+        "MaterialSettings": {
+            "color": {"r": 1.0, "g": 1.0, "b": 1.0, "a": 1.0},
+            "reflectionColor": {"r": 1.0, "g": 1.0, "b": 1.0, "a": 1.0},
+            "envLightColor": {"r": 1.0, "g": 1.0, "b": 1.0, "a": 1.0},
+            "opacity": 1.0,
+            "fresnelPower": 5.0,
+            "metallic": 0.0,
+            "roughness": 0.0,
+            "envLightIntensity": 1.0,
+            "reflectionIntensity": 1.0,
+            "normalMapIntensity": 1.0,
+            "sceneReflections": False,
+            "sceneLights": False,
+            "renderQueue": 2990,
+            "cullMode": 0,
+            "depthWrite": True,
+            "maskSettings": {
+                "driversMaskResolution": 32,
+                "driversSampleMode": 0,
+                "viewingAngleMappings": {
+                    "colorOverValue": {
+                        "interpolationType": 0,
+                        "controlPoints": [{"time": 0.0, "value": {"r": 1.0, "g": 1.0, "b": 1.0, "a": 1.0}}]
                     },
-                    "surfaceAngleMappings": {
-                        "colorOverValue": {
-                            "interpolationType": 0,
-                            "controlPoints": [{"time": 0.0, "value": {"r": 1.0, "g": 1.0, "b": 1.0, "a": 1.0}}]
-                        },
-                        "alphaOverValue": {
-                            "interpolationType": 0,
-                            "controlPoints": [{"time": 0.0, "value": 1.0}]
-                        },
-                        "scaleOverValue": {
-                            "interpolationType": 0,
-                            "controlPoints": [{"time": 0.0, "value": 1.0}]
-                        },
-                        "valueFrom": 0.0,
-                        "valueTo": 1.0
+                    "alphaOverValue": {
+                        "interpolationType": 0,
+                        "controlPoints": [{"time": 0.0, "value": 1.0}]
                     },
-                    "drivers": []
-                }
-            },
-            "TexturesSettings": {
-                "animationLayout": {
-                    "totalFrames": 1,
-                    "framesPerRow": 1,
-                    "framesPerColumn": 1,
-                    "frameDuration": 1.0
+                    "scaleOverValue": {
+                        "interpolationType": 0,
+                        "controlPoints": [{"time": 0.0, "value": 1.0}]
+                    },
+                    "valueFrom": 0.0,
+                    "valueTo": 1.0
                 },
-                "tilingLayout": {"x": 1.0, "y": 1.0, "z": 0.0, "w": 0.0},
-                "uvScroll": {"x": 0.0, "y": 0.0}
-            },
-            "Enabled": True,
-            "Name": "Custom Model",  # Generic name like in the example
-            "LocalTransform": {
-                "Position": {"x": 0.0, "y": 0.0, "z": 0.0},
-                "Rotation": {"x": 0.0, "y": 0.0, "z": 0.0},
-                "Scale": {"x": 1.0, "y": 1.0, "z": 1.0}
-            },
-            "ForceColorOverride": False,
-            "ColorOverride": {
-                "type": 0,
-                "hue": 0.0,
-                "saturation": 1.0,
-                "value": 1.0,
-                "hueShiftPerSecond": 0.0,
-                "fakeGlowMultiplier": 1.0,
-                "colorSource": 0
+                "surfaceAngleMappings": {
+                    "colorOverValue": {
+                        "interpolationType": 0,
+                        "controlPoints": [{"time": 0.0, "value": {"r": 1.0, "g": 1.0, "b": 1.0, "a": 1.0}}]
+                    },
+                    "alphaOverValue": {
+                        "interpolationType": 0,
+                        "controlPoints": [{"time": 0.0, "value": 1.0}]
+                    },
+                    "scaleOverValue": {
+                        "interpolationType": 0,
+                        "controlPoints": [{"time": 0.0, "value": 1.0}]
+                    },
+                    "valueFrom": 0.0,
+                    "valueTo": 1.0
+                },
+                "drivers": []
             }
         },
-        "Children": []
-    }
+        "TexturesSettings": {
+            "animationLayout": {
+                "totalFrames": 1,
+                "framesPerRow": 1,
+                "framesPerColumn": 1,
+                "frameDuration": 1.0
+            },
+            "tilingLayout": {"x": 1.0, "y": 1.0, "z": 0.0, "w": 0.0},
+            "uvScroll": {"x": 0.0, "y": 0.0}
+        },
+        "Enabled": True,
+        "Name": "Custom Model",  # Generic name like in the example
+        "LocalTransform": {
+            "Position": {"x": 0.0, "y": 0.0, "z": 0.0},
+            "Rotation": {"x": 0.0, "y": 0.0, "z": 0.0},
+            "Scale": {"x": 1.0, "y": 1.0, "z": 1.0}
+        },
+        "ForceColorOverride": False,
+        "ColorOverride": {
+            "type": 0,
+            "hue": 0.0,
+            "saturation": 1.0,
+            "value": 1.0,
+            "hueShiftPerSecond": 0.0,
+            "fakeGlowMultiplier": 1.0,
+            "colorSource": 0
+        }
+    },
+    "Children": []
+}
+
+def render_module_template(module):
+    """Serialize a module as JSON text indented for the preset's Modules list"""
+    return "    " + _dumps(module).decode('utf-8').replace("\n", "\n    ")
+
+# Modules are serialized once here; per preset/mesh only the marker strings
+# are substituted, so the constant parts are never re-walked by the serializer
+TRAIL_TEMPLATE = render_module_template(_TRAIL_MODULE_TEMPLATE)
+MODULE_TEMPLATE = render_module_template(_CUSTOM_MODEL_TEMPLATE)
+
+# ------------------ GENERATE PRESET ------------------
+
+# Pick first texture for trail if available
+trail_texture = texture_data[0]["filename"] if texture_data else ""
+
+preset = {
+    "ModVersion": "0.3.17",
+    "Version": 1,
+    "RootSettings": {
+        "Type": 0
+    },
+    "LocalTransform": {
+        "Position": {"x": 0.0, "y": 0.0, "z": 0.0},
+        "Rotation": {"x": 0.0, "y": 0.0, "z": 0.0},
+        "Scale": {"x": 1.0, "y": 1.0, "z": 1.0}
+    },
+    "Modules": MODULES_MARKER,  # Rendered from the module templates
+    "BinaryAssets": BINARY_ASSETS_MARKER  # Streamed in when the preset is saved
+}
+
+# Add trail module first (like in the example)
+module_parts = [TRAIL_TEMPLATE.replace(json.dumps(TRAIL_TEXTURE_MARKER), json.dumps(trail_texture))]
+
+# Add each mesh as a custom-model module (directly in Modules, not in containers)
+for mesh in mesh_data:
+    module_parts.append(MODULE_TEMPLATE.replace(json.dumps(MODEL_ID_MARKER), json.dumps(mesh["filename"])))
+    logger.debug("Added module for '%s'", mesh['name'])
     
-    # Add directly to preset modules
-    preset["Modules"].append(module)
-    log(f"Added module for '{mesh['name']}'")
+# ------------------ SAVE PRESET ------------------
+
+def stream_base64(src_path, f):
+    """Base64-encode a file into an open binary stream chunk by chunk"""
+    with open(src_path, 'rb') as src:
+        # Chunk size is a multiple of 3 so no padding appears mid-stream
+        while chunk := src.read(BASE64_CHUNK_SIZE):
+            f.write(base64.b64encode(chunk))
+
+def write_asset_list(f, key, assets):
+    """Write one BinaryAssets list, laid out like json.dump(indent=2)"""
+    if not assets:
+        f.write(f'    {json.dumps(key)}: []'.encode('utf-8'))
+        return
     
-    # Add to BinaryAssets
-    preset["BinaryAssets"]["Geometry"].append({
-        "AssetName": mesh["filename"],
-        "Data": mesh["data"]
-    })
-
-# Add textures to BinaryAssets
-for texture in texture_data:
-    preset["BinaryAssets"]["Textures"].append({
-        "AssetName": texture["filename"],
-        "Data": texture["data"]
-    })
-
-# Save preset
+    f.write(f'    {json.dumps(key)}: [\n'.encode('utf-8'))
+    for i, (asset_name, asset_path) in enumerate(assets):
+        f.write(f'      {{\n        "AssetName": {json.dumps(asset_name)},\n'.encode('utf-8'))
+        if SIDECAR_ASSETS:
+            # Path is relative to the preset file
+            data_file = f"{sidecar_dir.name}/{asset_name}.b64"
+            with open(OUTPUT_PRESETS / data_file, 'wb') as sidecar:
+                stream_base64(asset_path, sidecar)
+            f.write(f'        "DataFile": {json.dumps(data_file)}\n      }}'.encode('utf-8'))
+        else:
+            f.write(b'        "Data": "')
+            stream_base64(asset_path, f)
+            f.write(b'"\n      }')
+        f.write(b',\n' if i < len(assets) - 1 else b'\n')
+    f.write(b'    ]')
+
+# Embedded textures are read back from disk, so oxipng must be done first
+if EMBED_BINARY:
+    wait_png_optimizer()
+
 preset_file = OUTPUT_PRESETS / f"{saber_name}.json"
+sidecar_dir = OUTPUT_PRESETS / f"{saber_name}_assets"
+if EMBED_BINARY and SIDECAR_ASSETS:
+    sidecar_dir.mkdir(exist_ok=True)
 try:
-    with open(preset_file, "w", encoding="utf-8") as f:
-        json.dump(preset, f, indent=2)
-    log(f"\nPreset generated: {preset_file}")
+    # Serialize the preset skeleton, splice in the rendered modules, then
+    # stream the base64 payloads into the BinaryAssets marker's place
+    modules_json = ("[\n" + ",\n".join(module_parts) + "\n  ]").encode('utf-8')
+    preset_json = _dumps(preset).replace(_dumps(MODULES_MARKER), modules_json)
+    head, tail = preset_json.split(_dumps(BINARY_ASSETS_MARKER))
+    with open(preset_file, "wb") as f:
+        f.write(head)
+        f.write(b"{\n")
+        for i, (key, assets) in enumerate(binary_assets.items()):
+            write_asset_list(f, key, assets)
+            f.write(b",\n" if i < len(binary_assets) - 1 else b"\n")
+        f.write(b"  }")
+        f.write(tail)
+    logger.info("\nPreset generated: %s", preset_file)
 except Exception as e:
     error(f"Failed to write preset: {e}")
 
-log("\n✅ Conversion complete!")
-log(f"Preset file: {preset_file}")
-log(f"\nCopy the entire '{OUTPUT_DIR.name}/' folder to:")
-log(f"  Beat Saber/UserData/ReeSabers/")
-log(f"\nExtracted:")
-log(f"  - {len(mesh_data)} mesh(es) → CustomGeometry/")
-log(f"  - {len(texture_data)} texture(s) → CustomTextures/")
-log(f"  - 1 preset → Presets/")
-log(f"\nNote: Adjust positions, rotations, scales, and materials in-game as needed.")
\ No newline at end of file
+wait_png_optimizer()
+
+logger.info("\n✅ Conversion complete!")
+logger.info("Preset file: %s", preset_file)
+logger.info("\nCopy the entire '%s/' folder to:", OUTPUT_DIR.name)
+logger.info("  Beat Saber/UserData/ReeSabers/")
+logger.info("\nExtracted:")
+logger.info("  - %d mesh(es) → CustomGeometry/", len(mesh_data))
+logger.info("  - %d texture(s) → CustomTextures/", len(texture_data))
+logger.info("  - 1 preset → Presets/")
+logger.info("\nNote: Adjust positions, rotations, scales, and materials in-game as needed.")